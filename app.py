@@ -1,20 +1,29 @@
 from __future__ import division
 
 import csv
+import gzip
 import json
 import os
+import re
+import shutil
+import tempfile
 import urllib
 
-from collections import defaultdict, OrderedDict
+from cStringIO import StringIO
+from collections import Counter, defaultdict, OrderedDict
 from datetime import datetime, timedelta
-from decimal import Decimal
-from itertools import groupby
 
 import boto
-from boto.s3.key import Key
 
+import ciso8601
+
+import gevent
 import grequests
+import pylibmc
 import requests
+import ujson
+
+from requests.adapters import HTTPAdapter
 
 from flask import (abort, Flask, redirect, render_template, request, session,
                    Response)
@@ -24,10 +33,17 @@ from werkzeug.contrib.cache import MemcachedCache
 import local
 
 log_cache = os.path.join(os.path.dirname(__file__), 'cache')
-cache = MemcachedCache([os.getenv('MEMCACHE_URL', 'localhost:11211')])
+cache = MemcachedCache(pylibmc.Client(
+    [os.getenv('MEMCACHE_URL', 'localhost:11211')], binary=True,
+    behaviors={'tcp_nodelay': True, 'ketama': True}))
 
 app = Flask(__name__)
 
+# Keep connections to the APIs we talk to open between requests.
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=20,
+                                           pool_maxsize=50))
+
 servers = {
     'dev': 'https://marketplace-dev.allizom.org',
     'stage': 'https://marketplace.allizom.org',
@@ -59,6 +75,43 @@ builds = {
                'andymckay/django-statsd', 'andymckay/mozilla-logger']
 }
 
+jenkins_urls = [
+    (key, 'https://ci.mozilla.org/job/{0}/lastCompletedBuild/api/json'
+          .format(key))
+    for key in builds['jenkins']]
+
+travis_urls = [
+    (key, 'https://api.travis-ci.org/repositories/{0}.json'.format(key))
+    for key in builds['travis']]
+
+json_headers = {'Accept': 'application/json'}
+
+manifest_data = ujson.dumps({
+    "name": "Metaplace",
+    "description": "Information about the marketplace",
+    "launch_path": "/",
+    "icons": {
+        "128": "/img/icon-128.png"
+    },
+    "developer": {
+        "name": "Andy McKay",
+        "url": "https://mozilla..org"
+    },
+    "default_locale": "en"
+})
+
+log_date = re.compile(r'\d{4}-\d{2}-\d{2}\Z')
+
+# The links to recent logs, keyed by the day they were made for.
+recent_dates = {}
+
+# The last price tiers fetched from each server, with their ETag and
+# Last-Modified headers.
+tiers_cache = {}
+
+# Rendered pages that are the same for every request.
+rendered = {}
+
 statuses = {
     '0': ['pending', 'null'],
     '1': ['completed', 'success'],
@@ -72,41 +125,38 @@ statuses = {
 def notify(msg, *args):
     esc = urllib.urlencode(dict(['args', a] for a in args), doseq=True)
     url = 'https://notify.paas.allizom.org/notify/{0}/?{1}'.format(msg, esc)
-    requests.post(url, headers={'Authorization':
-                                'Basic {0}'.format(local.NOTIFY_AUTH)})
+    http_session.post(url, headers={'Authorization':
+                                    'Basic {0}'.format(local.NOTIFY_AUTH)})
 
 
 @app.route('/')
 def base(name=None):
-    return render_template('index.html', name=name)
+    # The layout shows who is logged in, so only the anonymous page is the
+    # same for everyone.
+    if name or session.get('email'):
+        return render_template('index.html', name=name)
 
+    if 'index' not in rendered:
+        rendered['index'] = render_template('index.html', name=None)
+    return rendered['index']
 
-def get_jenkins(keys, results):
-    reqs = []
-    for key in keys:
-        url = ('https://ci.mozilla.org/job/{0}/lastCompletedBuild/api/json'
-               .format(key))
-        reqs.append(grequests.get(url, headers={'Accept': 'application/json'}))
 
-    resps = grequests.map(reqs)
-    for key, resp in zip(keys, resps):
-        results['results'][key] = resp.json()['result'] == 'SUCCESS'
+def jenkins_passed(resp):
+    return ujson.loads(resp.content)['result'] == 'SUCCESS'
 
-    return results
 
+def travis_passed(resp):
+    return ujson.loads(resp.content)['last_build_result'] == 0
 
-def get_travis(keys, results):
-    reqs = []
-    for key in keys:
-        url = ('https://api.travis-ci.org/repositories/{0}.json'
-               .format(key))
-        reqs.append(grequests.get(url, headers={'Accept': 'application/json'}))
 
-    resps = grequests.map(reqs)
-    for key, resp in zip(keys, resps):
-        results['results'][key] = resp.json()['last_build_result'] == 0
+def get_jenkins():
+    return [(key, grequests.get(url, headers=json_headers), jenkins_passed)
+            for key, url in jenkins_urls]
 
-    return results
+
+def get_travis():
+    return [(key, grequests.get(url, headers=json_headers), travis_passed)
+            for key, url in travis_urls]
 
 
 def get_build():
@@ -114,21 +164,20 @@ def get_build():
 
     if not result:
         result = {'when': datetime.now(), 'results': {}}
-        get_jenkins(builds['jenkins'], result)
-        get_travis(builds['travis'], result)
+        # Send every request in one map so they all run at the same time.
+        reqs = get_jenkins() + get_travis()
+        resps = grequests.map([req for _, req, _ in reqs], size=len(reqs))
+        for (key, _, passed), resp in zip(reqs, resps):
+            result['results'][key] = passed(resp)
         cache.set('build', result, timeout=60 * 5)
 
-    result['results'] = OrderedDict(sorted(result['results'].items()))
     passing = all(result['results'].values())
-    last = bool(cache.get('last-build'))
-
-    cache.set('last-build', True)
-    if last is None:
-        cache.set('last-build', bool(passing))
-
-    elif last != passing:
-        #notify('builds', 'passing' if passing else 'failing')
-        cache.set('last-build', bool(passing))
+    last = cache.get('last-build')
+    if last != passing:
+        # Nothing has changed if this is the first time we've looked.
+        #if last is not None:
+        #    notify('builds', 'passing' if passing else 'failing')
+        cache.set('last-build', passing, timeout=0)
 
     return result, passing
 
@@ -136,9 +185,12 @@ def get_build():
 @app.route('/build/')
 def build():
     result, passing = get_build()
+    result['results'] = OrderedDict(sorted(result['results'].items()))
 
     if 'application/json' in request.headers['Accept']:
         result['when'] = result['when'].isoformat()
+        # ujson writes the OrderedDict out in hash order, the stdlib keeps the
+        # sorted order and this payload is small.
         return json.dumps({'all': passing, 'result': result})
 
     return render_template('build.html', result=result, request=request,
@@ -152,28 +204,17 @@ def debug():
 
 @app.route('/manifest.webapp')
 def manifest():
-    data = json.dumps({
-        "name": "Metaplace",
-        "description": "Information about the marketplace",
-        "launch_path": "/",
-        "icons": {
-            "128": "/img/icon-128.png"
-        },
-        "developer": {
-            "name": "Andy McKay",
-            "url": "https://mozilla..org"
-        },
-        "default_locale": "en"
-    })
-    return Response(data, mimetype='application/x-web-app-manifest+json')
+    res = Response(manifest_data,
+                   mimetype='application/x-web-app-manifest+json')
+    res.cache_control.public = True
+    res.cache_control.max_age = 60 * 60 * 24
+    return res
 
 
 def fill_tiers(result):
     for tier in result['objects']:
-        prices = {}
-        for price in tier['prices']:
-            prices[price['region']] = price
-        tier['prices'] = prices
+        tier['prices'] = dict((price['region'], price)
+                              for price in tier['prices'])
 
     return result
 
@@ -182,9 +223,23 @@ def fill_tiers(result):
 @app.route('/tiers/<server>/')
 def tiers(server=None):
     if server:
-        res = requests.get('{0}{1}'.format(
-            servers[server], api['tiers']))
-        result = fill_tiers(res.json())
+        # The prices rarely change, so ask the server if ours are still good.
+        headers = {}
+        etag, modified, result = tiers_cache.get(server, (None, None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+        res = http_session.get('{0}{1}'.format(
+            servers[server], api['tiers']), headers=headers)
+        if res.status_code != 304:
+            result = fill_tiers(ujson.loads(res.content))
+            etag = res.headers.get('ETag')
+            modified = res.headers.get('Last-Modified')
+            if etag or modified:
+                tiers_cache[server] = (etag, modified, result)
+
         return render_template('tiers.html', result=result['objects'],
                                regions=regions, sorted=regions_sorted,
                                methods=methods, server=server)
@@ -195,14 +250,102 @@ def tiers(server=None):
 def s3_get(server, src_filename, dest_filename):
     conn = boto.connect_s3(local.S3_AUTH[server]['key'],
                            local.S3_AUTH[server]['secret'])
-    bucket = conn.get_bucket(local.S3_BUCKET[server])
-    k = Key(bucket)
-    k.key = src_filename
-    k.get_contents_to_filename(os.path.join(log_cache, dest_filename))
-
-
-def list_to_dict_multiple(listy):
-    return reduce(lambda x, (k,v): x[k].append(v) or x, listy, defaultdict(list))
+    # Only sign the URL with boto and do the download through requests, which
+    # runs on the gevent patched sockets and copies in large chunks.
+    url = conn.generate_url(60, 'GET', local.S3_BUCKET[server], src_filename)
+    res = http_session.get(url, stream=True)
+    res.raise_for_status()
+
+    # Write to a temporary file of our own so a failed or concurrent download
+    # never ends up in the cache looking like a complete log.
+    fd, tmp = tempfile.mkstemp(dir=log_cache)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            shutil.copyfileobj(res.raw, fp, 1 << 20)
+        os.rename(tmp, os.path.join(log_cache, dest_filename))
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def parse_datetime(value, fmt):
+    # ciso8601 returns None (or raises on newer releases) for anything it
+    # can't read, so fall back to the slower strptime for those.
+    try:
+        parsed = ciso8601.parse_datetime(value)
+    except ValueError:
+        parsed = None
+    return parsed or datetime.strptime(value, fmt)
+
+
+def parse_log(src):
+    lfmt = '%Y-%m-%dT%H:%M:%S'
+    # Read the log in large chunks rather than the default 8KB.
+    with open(src, 'rb', 1 << 20) as csvfile:
+        rows = []
+        stats = defaultdict(list)
+        diff_total, diff_count = 0, 0
+        status_counts = Counter()
+        currencies = defaultdict(list)
+        add_row = rows.append
+        parse = parse_datetime
+        # Transactions often share a timestamp, only parse each one once.
+        parsed = {}
+        reader = csv.reader(csvfile)
+        # Only the columns the page shows are kept, by position, rather
+        # than a dict of every column for each row.
+        header = next(reader, None)
+        if header is None:
+            return rows, stats
+
+        col = dict((name, i) for i, name in enumerate(header))
+        status_col, currency_col, amount_col, seller_col = (
+            col['status'], col['currency'], col['amount'], col['seller'])
+        created_col, modified_col = col['created'], col['modified']
+        for num, line in enumerate(reader, 1):
+            # Skip blank lines, as DictReader did.
+            if not line:
+                continue
+
+            # This is a long stretch of CPU work, let other requests run.
+            if not num % 1000:
+                gevent.sleep(0)
+
+            created = line[created_col]
+            modified = line[modified_col]
+            if created not in parsed:
+                parsed[created] = parse(created, lfmt)
+            if modified not in parsed:
+                parsed[modified] = parse(modified, lfmt)
+
+            status = line[status_col]
+            currency = line[currency_col]
+            amount = line[amount_col]
+            diff = parsed[modified] - parsed[created]
+            if diff:
+                diff_total += diff.total_seconds()
+                diff_count += 1
+            status_counts[status] += 1
+            if currency and amount:
+                currencies[currency].append(float(amount))
+
+            add_row({'status': status, 'currency': currency, 'amount': amount,
+                     'seller': line[seller_col], 'created': parsed[created],
+                     'diff': diff})
+
+        if diff_count:
+            stats['mean'] = '%.2f' % (diff_total / diff_count)
+
+        for status, count in sorted(status_counts.items()):
+            perc = (count / len(rows)) * 100
+            stats['statuses'].append((str(status), '%.2f' % perc))
+
+        stats['currencies'] = dict(
+            (currency, {'items': items, 'count': len(items),
+                        'mean': '%.2f' % (sum(items) / len(items))})
+            for currency, items in currencies.items())
+
+        return rows, stats
 
 
 @app.route('/transactions/')
@@ -212,55 +355,29 @@ def transactions(server=None, date=''):
         abort(403)
 
     sfmt = '%Y-%m-%d'
-    lfmt = sfmt + 'T%H:%M:%S'
-    today = datetime.today()
-    dates = (('-1 day', (today - timedelta(days=1)).strftime(sfmt)),
-             ('-2 days', (today - timedelta(days=2)).strftime(sfmt)),
-             ('-3 days', (today - timedelta(days=3)).strftime(sfmt)))
+    today = datetime.today().date()
+    if today not in recent_dates:
+        recent_dates.clear()
+        recent_dates[today] = (
+            ('-1 day', (today - timedelta(days=1)).strftime(sfmt)),
+            ('-2 days', (today - timedelta(days=2)).strftime(sfmt)),
+            ('-3 days', (today - timedelta(days=3)).strftime(sfmt)))
+    dates = recent_dates[today]
 
     if server and date:
-        date = datetime.strptime(date, sfmt)
-        src_filename = date.strftime(sfmt) + '.log'
-        dest_filename = date.strftime(sfmt) + '.' + server + '.log'
-        if dest_filename not in os.listdir(log_cache):
-            s3_get(server, src_filename, dest_filename)
+        if not log_date.match(date):
+            abort(404)
 
+        src_filename = date + '.log'
+        dest_filename = date + '.' + server + '.log'
         src = os.path.join(log_cache, dest_filename)
-        with open(src) as csvfile:
-            rows = []
-            stats = defaultdict(list)
-            for row in csv.DictReader(csvfile):
-                row['created'] = datetime.strptime(row['created'], lfmt)
-                row['modified'] = datetime.strptime(row['modified'], lfmt)
-                row['diff'] = row['modified'] - row['created']
-                if row['diff']:
-                    stats['diff'].append(row['diff'].total_seconds())
-                stats['status'].append(row['status'])
-
-                if row['currency'] and row['amount']:
-                    stats['currencies'].append((row['currency'],
-                                                Decimal(row['amount'])))
-
-                rows.append(row)
-
-            if len(stats['diff']):
-                stats['mean'] = '%.2f' % (sum(stats['diff'])/len(stats['diff']))
-
-            for status, group in groupby(sorted(stats['status'])):
-                group = len(list(group))
-                perc = (group / len(stats['status'])) * 100
-                stats['statuses'].append((str(status), '%.2f' % perc))
-
-            stats['currencies'] = list_to_dict_multiple(stats['currencies'])
-            for currency, items in stats['currencies'].items():
-                stats['currencies'][currency] = {'items': items}
-                stats['currencies'][currency]['count'] = len(items)
-                mean = (sum(items) / len(items))
-                stats['currencies'][currency]['mean'] = '%.2f' % mean
-
-            return render_template('transactions.html', rows=rows,
-                                   server=server, dates=dates, stats=stats,
-                                   statuses=statuses, filename=dest_filename)
+        if not os.path.exists(src):
+            s3_get(server, src_filename, dest_filename)
+
+        rows, stats = parse_log(src)
+        return render_template('transactions.html', rows=rows,
+                               server=server, dates=dates, stats=stats,
+                               statuses=statuses, filename=dest_filename)
     return render_template('transactions.html', dates=dates)
 
 
@@ -283,13 +400,13 @@ def login():
     # Send the assertion to Mozilla's verifier service.
     data = {'assertion': request.form['assertion'],
             'audience': 'https://metaplace.paas.allizom.org/'}
-    resp = requests.post('https://verifier.login.persona.org/verify',
-                         data=data, verify=True)
+    resp = http_session.post('https://verifier.login.persona.org/verify',
+                             data=data, verify=True)
 
     # Did the verifier respond?
     if resp.ok:
         # Parse the response
-        verification_data = json.loads(resp.content)
+        verification_data = ujson.loads(resp.content)
 
         # Check if the assertion was valid
         if verification_data['status'] == 'okay':
@@ -309,10 +426,30 @@ def logout():
     return 'You are logged out'
 
 
+def gzip_response(response):
+    if ('gzip' not in request.headers.get('Accept-Encoding', '').lower()
+        or response.status_code != 200 or response.direct_passthrough
+        or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    # Not worth it for small responses like the manifest.
+    if len(data) < 500:
+        return response
+
+    buf = StringIO()
+    with gzip.GzipFile(mode='wb', compresslevel=6, fileobj=buf) as gz:
+        gz.write(data)
+    response.set_data(buf.getvalue())
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 @app.after_request
 def after_request(response):
     response.headers.add('Strict-Transport-Security', 'max-age=31536000')
-    return response
+    return gzip_response(response)
 
 
 if __name__ == '__main__':